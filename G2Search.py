@@ -12,7 +12,12 @@ import logging
 import re
 import json
 import csv
+import contextlib
+import copy
+import collections
 import concurrent.futures
+import threading
+import heapq
 
 try:
     import orjson
@@ -37,6 +42,7 @@ class SZSearch:
         self.data_source_filter = kwargs.get("data_source_filter", "").upper()
         self.scoring_config = kwargs.get("scoring_config", {})
         self.column_mappings = kwargs.get("column_mappings", [])
+        self.do_audit = kwargs.get("do_audit", False)
 
         search_flag_list = [
             "G2_SEARCH_INCLUDE_STATS",
@@ -68,6 +74,28 @@ class SZSearch:
             "DRIVERS_LICENSE": 4,
         }
 
+        # features not in the scoring config are scored with its DEFAULT entry
+        self.default_score_config = self.scoring_config.get(
+            "DEFAULT", {"threshold": 0, "+weight": 100}
+        )
+        self.feature_scoring = {}
+        for feature_code in set(self.scoring_config) | set(self.feature_order):
+            if feature_code != "DEFAULT":
+                self.compile_feature_scoring(feature_code)
+
+    def compile_feature_scoring(self, feature_code):
+        """precomputes (sort_key, score_code, threshold, +weight factor, -weight) for a feature"""
+        score_config = self.scoring_config.get(feature_code, self.default_score_config)
+        feature_scoring = (
+            (self.feature_order.get(feature_code, 99), feature_code),
+            "GNR_FN" if feature_code == "NAME" else "FULL_SCORE",
+            score_config.get("threshold", 0),
+            score_config.get("+weight", 100) / 100,
+            score_config.get("-weight", 0),
+        )
+        self.feature_scoring[feature_code] = feature_scoring
+        return feature_scoring
+
     def __del__(self):
         self.g2_engine.destroy()
 
@@ -82,7 +110,12 @@ class SZSearch:
             )
         except G2Exception as ex:
             print("-->", ex)
-            return {"error": ex}
+            return {
+                "error": ex,
+                "search_record": {"ROW_ID": row_id},
+                "api_ms": time.time() - start_time,
+                "fmt_ms": 0,
+            }
         search_data = {"api_ms": time.time() - start_time}
 
         start_time = time.time()
@@ -90,14 +123,41 @@ class SZSearch:
         scored_entities = self.score_entities(
             search_response.get("RESOLVED_ENTITIES", [])
         )
-        returned_entities = self.filter_entities(scored_entities)
-        search_data["search_record"] = orjson.loads(search_string)
+        search_data.update(
+            self.row_result(row_id, orjson.loads(search_string), scored_entities)
+        )
+        search_data["fmt_ms"] = time.time() - start_time
+
+        return search_data
+
+    def duplicate_result(self, search_data, row_id, search_record):
+        """the result of another row's search for a row with the same search payload"""
+        if "error" in search_data:
+            duplicate_data = dict(search_data)
+            duplicate_data["search_record"] = {"ROW_ID": row_id}
+            duplicate_data["api_ms"] = 0
+            return duplicate_data
+        start_time = time.time()
+        duplicate_data = {"api_ms": 0}
+        # only the returned entities can pass the filters again, and filtering and
+        # formatting update them, so each row gets its own copies
+        duplicate_data.update(
+            self.row_result(
+                row_id,
+                search_record,
+                [dict(x) for x in search_data["returned_entities"]],
+            )
+        )
+        duplicate_data["fmt_ms"] = time.time() - start_time
+        return duplicate_data
+
+    def row_result(self, row_id, search_record, scored_entities):
+        search_data = {}
+        search_data["search_record"] = search_record
         search_data["search_record"]["ROW_ID"] = row_id
         search_data["scored_entities"] = scored_entities
-        search_data["returned_entities"] = returned_entities
+        search_data["returned_entities"] = self.filter_entities(scored_entities)
         search_data["formatted_rows"] = self.format_response(search_data)
-        search_data["fmt_ms"] = time.time() - start_time
-
         return search_data
 
     def score_entities(self, entity_list):
@@ -137,18 +197,22 @@ class SZSearch:
             all_matched = []
             all_details = []
 
-            for feature_code in sorted(
-                entity_data["MATCH_INFO"]["FEATURE_SCORES"].keys(),
-                key=lambda x: (self.feature_order.get(x, 99), x),
-            ):
-                score_code = "GNR_FN" if feature_code == "NAME" else "FULL_SCORE"
-                score_config = self.scoring_config.get(
-                    feature_code, {"threshold": 0, "+weight": 100}
-                )
-                best_score_record = sorted(
-                    entity_data["MATCH_INFO"]["FEATURE_SCORES"][feature_code],
-                    key=lambda x: x[score_code],
-                )[-1]
+            feature_scores = entity_data["MATCH_INFO"]["FEATURE_SCORES"]
+            feature_list = []
+            for feature_code in feature_scores:
+                feature_scoring = self.feature_scoring.get(feature_code)
+                if not feature_scoring:
+                    feature_scoring = self.compile_feature_scoring(feature_code)
+                feature_list.append((feature_scoring, feature_code))
+            feature_list.sort()
+
+            for feature_scoring, feature_code in feature_list:
+                _, score_code, threshold, plus_factor, minus_weight = feature_scoring
+                # last of the highest scores, same as sorting and taking [-1]
+                best_score_record = feature_scores[feature_code][0]
+                for score_record in feature_scores[feature_code][1:]:
+                    if score_record[score_code] >= best_score_record[score_code]:
+                        best_score_record = score_record
                 matched_entity[f"{feature_code}_SCORE"] = best_score_record[score_code]
                 matched_entity[f"{feature_code}_SEARCHED"] = best_score_record[
                     "INBOUND_FEAT"
@@ -179,12 +243,12 @@ class SZSearch:
                 matched_entity[f"{feature_code}_DETAILS"] = matching_details
                 matched_entity["RAW_SCORING_DATA"][feature_code] = best_score_record
 
-                if best_score_record[score_code] >= score_config["threshold"]:
-                    matched_entity["MATCH_SCORE"] += best_score_record[score_code] * (
-                        score_config["+weight"] / 100
+                if best_score_record[score_code] >= threshold:
+                    matched_entity["MATCH_SCORE"] += (
+                        best_score_record[score_code] * plus_factor
                     )
-                elif score_config.get("-weight"):
-                    matched_entity["MATCH_SCORE"] -= score_config["-weight"]
+                elif minus_weight:
+                    matched_entity["MATCH_SCORE"] -= minus_weight
 
             matched_entity["MATCHED_SCORES"] = " | ".join(all_scores)
             matched_entity["MATCHED_VALUES"] = " | ".join(all_details)
@@ -252,7 +316,7 @@ class SZSearch:
         for matched_entity in returned_entities:
 
             audit_status = "n/a"
-            if search_record_id and args.do_audit:
+            if search_record_id and self.do_audit:
                 if matched_entity["MATCH_NUMBER"] == 0:
                     audit_status = "false_negative"
                 else:
@@ -283,6 +347,450 @@ class SZSearch:
         return formatted_rows
 
 
+class SearchScheduler:
+    """runs searches on worker threads by priority class and deadline"""
+
+    # highest priority first
+    priority_classes = ("interactive", "batch")
+
+    def __init__(
+        self, engine, thread_count=None, class_limits=None, interactive_threads=0
+    ):
+        """interactive_threads limits batch searches to the rest of the threads"""
+        self.engine = engine
+        self.thread_count = thread_count or min(32, (os.cpu_count() or 1) + 4)
+        self.class_limits = dict(class_limits or {})
+        if interactive_threads:
+            self.class_limits["batch"] = max(self.thread_count - interactive_threads, 1)
+        self.running = {x: 0 for x in self.priority_classes}
+        self.expired_count = {x: 0 for x in self.priority_classes}
+        self.queue = []
+        self.sequence = itertools.count()
+        self.shutting_down = False
+        self.condition = threading.Condition()
+        self.workers = []
+        for i in range(self.thread_count):
+            worker = threading.Thread(
+                target=self.worker, name=f"SearchScheduler_{i}", daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def submit(self, row_id, search_string, priority_class="batch", deadline=None):
+        """deadline is an absolute time.time(), the search is skipped if it has not started by then"""
+        return self.queue_task(
+            row_id, self.engine.search, (row_id, search_string), priority_class, deadline
+        )
+
+    def submit_duplicate(
+        self, search_data, row_id, search_record, priority_class="batch", deadline=None
+    ):
+        """filters and formats another row's search result for a row with the same search payload"""
+        return self.queue_task(
+            row_id,
+            self.engine.duplicate_result,
+            (search_data, row_id, search_record),
+            priority_class,
+            deadline,
+        )
+
+    def queue_task(self, row_id, function, function_args, priority_class, deadline):
+        if priority_class not in self.priority_classes:
+            raise ValueError(f"unknown priority class {priority_class}")
+        future = concurrent.futures.Future()
+        with self.condition:
+            if self.shutting_down:
+                raise RuntimeError("cannot submit after shutdown")
+            heapq.heappush(
+                self.queue,
+                (
+                    self.priority_classes.index(priority_class),
+                    deadline if deadline else float("inf"),
+                    next(self.sequence),
+                    priority_class,
+                    row_id,
+                    (function, function_args),
+                    future,
+                ),
+            )
+            self.condition.notify()
+        return future
+
+    def shutdown(self, wait=True):
+        with self.condition:
+            self.shutting_down = True
+            self.condition.notify_all()
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+    def next_request(self):
+        """highest priority queued request whose class is under its limit"""
+        skipped = []
+        request = None
+        while self.queue:
+            candidate = heapq.heappop(self.queue)
+            class_limit = self.class_limits.get(candidate[3])
+            if class_limit and self.running[candidate[3]] >= class_limit:
+                skipped.append(candidate)
+                continue
+            request = candidate
+            break
+        for candidate in skipped:
+            heapq.heappush(self.queue, candidate)
+        return request
+
+    def worker(self):
+        while True:
+            with self.condition:
+                request = self.next_request()
+                while not request:
+                    if self.shutting_down and not self.queue:
+                        return
+                    self.condition.wait()
+                    request = self.next_request()
+                _, deadline, _, priority_class, row_id, task, future = request
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if time.time() > deadline:
+                    self.expired_count[priority_class] += 1
+                    future.set_result(
+                        {
+                            "error": "deadline expired",
+                            "expired": True,
+                            "search_record": {"ROW_ID": row_id},
+                            "api_ms": 0,
+                            "fmt_ms": 0,
+                        }
+                    )
+                    continue
+                self.running[priority_class] += 1
+            try:
+                future.set_result(task[0](*task[1]))
+            except Exception as ex:
+                future.set_exception(ex)
+            finally:
+                with self.condition:
+                    self.running[priority_class] -= 1
+                    self.condition.notify_all()
+
+
+class SamplingProfiler:
+    """samples the stacks of all threads on an interval"""
+
+    def __init__(self, interval_ms=10, warmup_seconds=0, duration_seconds=0):
+        self.interval = max(interval_ms, 1) / 1000
+        self.warmup_seconds = warmup_seconds
+        self.duration_seconds = duration_seconds
+        self.stack_counts = {}
+        self.frame_labels = {}
+        self.idle_labels = set()
+        self.thread_roots = {}
+        # the profiler's and the stats writer's own threads are not part of the search work
+        self.skipped_threads = ("G2SearchProfiler", "G2SearchStatsWriter")
+        self.sample_count = 0
+        self.started = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="G2SearchProfiler", daemon=True
+        )
+
+    def start(self):
+        self.started = time.time()
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        my_ident = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            elapsed = time.time() - self.started
+            if elapsed < self.warmup_seconds:
+                continue
+            if (
+                self.duration_seconds
+                and elapsed > self.warmup_seconds + self.duration_seconds
+            ):
+                break
+            current_frames = sys._current_frames()
+            if any(x not in self.thread_roots for x in current_frames):
+                self.refresh_thread_roots()
+            for thread_id, frame in current_frames.items():
+                thread_root = self.thread_roots.get(thread_id, str(thread_id))
+                if thread_id == my_ident or thread_root in self.skipped_threads:
+                    continue
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    frame_label = self.frame_labels.get(code)
+                    if not frame_label:
+                        frame_label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                        self.frame_labels[code] = frame_label
+                        # a thread whose innermost frame is in threading is blocked waiting
+                        if code.co_filename == threading.__file__:
+                            self.idle_labels.add(frame_label)
+                    stack.append(frame_label)
+                    frame = frame.f_back
+                stack.append(thread_root)
+                stack_key = tuple(stack)
+                self.stack_counts[stack_key] = self.stack_counts.get(stack_key, 0) + 1
+            self.sample_count += 1
+
+    def refresh_thread_roots(self):
+        # worker threads are named <pool>_<n>, roll them up into one root
+        self.thread_roots = {
+            x.ident: re.sub(r"_\d+$", "", x.name) for x in threading.enumerate()
+        }
+
+    def write_collapsed(self, file_name):
+        with open(file_name, "w") as out_file:
+            for stack_key, count in sorted(
+                (";".join(reversed(x)), y) for x, y in self.stack_counts.items()
+            ):
+                out_file.write(f"{stack_key} {count}\n")
+
+    def summary(self):
+        """busy samples per function, overall and per thread root, idle waits are only counted"""
+        busy_stacks = {}
+        thread_summary = {}
+        for stack_key, count in self.stack_counts.items():
+            # stack keys are innermost frame first with the thread root last
+            thread_root = stack_key[-1]
+            if thread_root not in thread_summary:
+                thread_summary[thread_root] = {"busy_samples": 0, "idle_samples": 0}
+            if stack_key[0] in self.idle_labels:
+                thread_summary[thread_root]["idle_samples"] += count
+            else:
+                thread_summary[thread_root]["busy_samples"] += count
+                busy_stacks[stack_key] = count
+        for thread_root in thread_summary:
+            thread_summary[thread_root]["functions"] = summarize_functions(
+                {x: y for x, y in busy_stacks.items() if x[-1] == thread_root}
+            )
+        return {
+            "interval_ms": round(self.interval * 1000, 3),
+            "warmup_seconds": self.warmup_seconds,
+            "duration_seconds": self.duration_seconds,
+            "sample_count": self.sample_count,
+            "busy_samples": sum(busy_stacks.values()),
+            "idle_samples": sum(x["idle_samples"] for x in thread_summary.values()),
+            "functions": summarize_functions(busy_stacks),
+            "threads": dict(
+                sorted(
+                    thread_summary.items(),
+                    key=lambda item: item[1]["busy_samples"],
+                    reverse=True,
+                )
+            ),
+        }
+
+    def write_summary(self, file_name):
+        with open(file_name, "w") as out_file:
+            out_file.write(json.dumps(self.summary(), indent=4))
+
+
+def summarize_functions(stack_counts):
+    functions = {}
+    for stack_key, count in stack_counts.items():
+        frames = stack_key[:-1]
+        if not frames:
+            continue
+        for function_name in set(frames):
+            if function_name not in functions:
+                functions[function_name] = {"self": 0, "total": 0}
+            functions[function_name]["total"] += count
+        functions[frames[0]]["self"] += count
+    total_samples = sum(stack_counts.values()) or 1
+    for function_name in functions:
+        functions[function_name]["self_pct"] = round(
+            functions[function_name]["self"] / total_samples * 100, 2
+        )
+        functions[function_name]["total_pct"] = round(
+            functions[function_name]["total"] / total_samples * 100, 2
+        )
+    return dict(
+        sorted(
+            functions.items(),
+            key=lambda item: (item[1]["self"], item[1]["total"]),
+            reverse=True,
+        )
+    )
+
+
+class EngineStatsRecorder:
+    """appends timed engine stats samples to an ndjson file
+
+    the engine resets its workload counters each time they are read, so each
+    sample already covers just the interval since the prior one
+    """
+
+    def __init__(self, g2_engine, file_name, interval_seconds=60):
+        self.g2_engine = g2_engine
+        self.file_name = file_name
+        self.interval_seconds = interval_seconds
+        # discard what was counted while priming so the first sample starts here
+        try:
+            self.g2_engine.stats(bytearray())
+        except G2Exception as ex:
+            logging.warning(f"engine stats failed: {ex}")
+        self.started = time.time()
+        self.next_sample_time = self.started + interval_seconds
+        self.last_sample_time = self.started
+        self.last_search_count = 0
+        self.sample_count = 0
+        open(self.file_name, "w").close()
+
+    def due(self):
+        return self.interval_seconds and time.time() >= self.next_sample_time
+
+    def sample(self, search_count, in_flight_count):
+        sample_time = time.time()
+        try:
+            response = bytearray()
+            self.g2_engine.stats(response)
+            stats = orjson.loads(response)
+        except G2Exception as ex:
+            logging.warning(f"engine stats failed: {ex}")
+            return
+        elapsed = sample_time - self.last_sample_time
+        stats_sample = {
+            "sampled": datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S"),
+            "elapsed_seconds": round(sample_time - self.started, 1),
+            "interval_seconds": round(elapsed, 1),
+            "search_count": search_count,
+            "searches_per_second": (
+                round((search_count - self.last_search_count) / elapsed, 1)
+                if elapsed > 0
+                else 0
+            ),
+            "in_flight_count": in_flight_count,
+            "stats": stats,
+        }
+        with open(self.file_name, "a") as out_file:
+            out_file.write(json.dumps(stats_sample) + "\n")
+        self.sample_count += 1
+        self.last_sample_time = sample_time
+        self.last_search_count = search_count
+        while self.next_sample_time <= sample_time:
+            self.next_sample_time += self.interval_seconds
+        return stats_sample
+
+
+class StatsWriter:
+    """writes the latest stat_pack snapshot to the json stats file on a background thread"""
+
+    def __init__(self, file_name, match_key_limit=0):
+        self.file_name = file_name
+        self.match_key_limit = match_key_limit
+        self.pending = None
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(
+            target=self.run, name="G2SearchStatsWriter", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, stat_pack):
+        """queues a snapshot of the stat_pack, replacing any snapshot not yet written"""
+        snapshot = self.snapshot(stat_pack)
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify()
+
+    def snapshot(self, stat_pack):
+        """copies the stat_pack with its match keys already capped, the only unbounded part of it"""
+        snapshot = {}
+        for section, values in stat_pack.items():
+            if section == "match_keys":
+                snapshot[section] = {
+                    x: cap_match_keys(y, self.match_key_limit) for x, y in values.items()
+                }
+            else:
+                snapshot[section] = copy.deepcopy(values)
+        return snapshot
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closing:
+                    self.condition.wait()
+                snapshot = self.pending
+                self.pending = None
+            if snapshot:
+                try:
+                    self.write(snapshot)
+                except Exception as ex:
+                    logging.warning(f"could not write stats snapshot: {ex}")
+            elif self.closing:
+                return
+
+    def write(self, snapshot):
+        if not self.match_key_limit:
+            for match_key_type in snapshot.get("match_keys", {}):
+                snapshot["match_keys"][match_key_type] = dict(
+                    sorted(
+                        snapshot["match_keys"][match_key_type].items(),
+                        key=lambda item: item[1],
+                        reverse=True,
+                    )
+                )
+        try:
+            write_file_atomic(self.file_name, dump_json(snapshot))
+        except OSError as ex:
+            logging.warning(f"could not write {self.file_name}: {ex}")
+        else:
+            logging.info(
+                f"stats written to {self.file_name}: {json.dumps(snapshot.get('counts', {}))}"
+            )
+
+
+def cap_match_keys(match_keys, limit=0):
+    """keeps the top (n) match keys by count and sums the rest into other, copies them all without a limit"""
+    if not limit or len(match_keys) <= limit:
+        return dict(match_keys)
+    capped_keys = dict(
+        heapq.nlargest(limit, match_keys.items(), key=lambda item: item[1])
+    )
+    other_count = sum(match_keys.values()) - sum(capped_keys.values())
+    capped_keys["other"] = capped_keys.get("other", 0) + other_count
+    return capped_keys
+
+
+def dump_json(data):
+    """compact json, orjson when it is installed"""
+    if orjson is json:
+        return json.dumps(data, separators=(",", ":")).encode()
+    return orjson.dumps(data)
+
+
+def write_file_atomic(file_name, data):
+    """readers see either the prior file or the new one, never a partial write"""
+    temp_file_name = f"{file_name}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file_name, "wb") as out_file:
+            out_file.write(data)
+        os.replace(temp_file_name, file_name)
+    except OSError:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+
+
 def prepare_output(output_columns):
     column_headers = []
     column_mappings = []
@@ -302,6 +810,61 @@ def record_in_list(data_source, record_id, record_list):
     return False
 
 
+def normalize_search_value(value):
+    if type(value) == str:
+        return value.strip()
+    if type(value) == dict:
+        stripped_items = {}
+        for key, item_value in value.items():
+            key = key.strip() if type(key) == str else key
+            if key:
+                stripped_items[key] = item_value
+        normalized = {}
+        for key in sorted(stripped_items):
+            normalized_value = normalize_search_value(stripped_items[key])
+            if normalized_value not in ("", None, [], {}):
+                normalized[key] = normalized_value
+        return normalized
+    if type(value) == list:
+        return [
+            x
+            for x in (normalize_search_value(y) for y in value)
+            if x not in ("", None, [], {})
+        ]
+    return value
+
+
+def normalize_search_record(record):
+    """trims values, drops empty ones and sorts the keys so identical searches compare equal"""
+    if type(record) != dict:
+        record = orjson.loads(record)
+    return normalize_search_value(record)
+
+
+def search_record_key(search_record):
+    """the record's search payload, the audit attributes are not part of the search"""
+    return json.dumps(
+        {
+            x: search_record[x]
+            for x in search_record
+            if x not in ("DATA_SOURCE", "RECORD_ID")
+        }
+    )
+
+
+def read_search_records(reader):
+    """yields (row_id, search_record, error) with each search record normalized"""
+    row_id = 0
+    for record in reader:
+        row_id += 1
+        if type(record) == str and not record.strip():
+            continue
+        try:
+            yield row_id, normalize_search_record(record), None
+        except ValueError as ex:
+            yield row_id, None, f"invalid json: {ex}"
+
+
 def get_next_record(reader):
     try:
         return next(reader)
@@ -309,7 +872,10 @@ def get_next_record(reader):
         return None
 
 
-def file_search(engine, input_file, output_file, column_headers):
+def file_search(
+    engine, input_file, output_file, column_headers, shared_scheduler=None
+):
+    """searches each record of the input file as batch work, on the scheduler if one is passed in so it can be shared with interactive searches"""
 
     output_file_name, output_file_ext = os.path.splitext(output_file)
     csv_output_file = output_file_name + ".csv"
@@ -325,6 +891,8 @@ def file_search(engine, input_file, output_file, column_headers):
         "counts": {
             "search_count": 0,
             "error_count": 0,
+            "expired_count": 0,
+            "duplicate_count": 0,
             "found_count": 0,
             "matched_count": 0,
             "possible_count": 0,
@@ -356,6 +924,22 @@ def file_search(engine, input_file, output_file, column_headers):
 
     max_workers = args.thread_count if args.thread_count else None
 
+    profiler = None
+    if args.profile:
+        profiler = SamplingProfiler(
+            args.profile_interval, args.profile_warmup, args.profile_duration
+        )
+        profiler.start()
+        logging.info(
+            f"profiling every {args.profile_interval}ms after {args.profile_warmup} second warm-up"
+        )
+
+    stats_writer = StatsWriter(json_output_file, args.match_key_limit)
+
+    stats_recorder = EngineStatsRecorder(
+        engine.g2_engine, output_file_name + "_engine_stats.ndjson", args.stats_interval
+    )
+
     proc_start_time = time.time()
     with open(csv_output_file, mode="w", newline="", encoding="utf-8-sig") as out_file:
 
@@ -372,31 +956,114 @@ def file_search(engine, input_file, output_file, column_headers):
             else:
                 reader = in_file
 
-            with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
-                logging.info(f"starting {executor._max_workers} threads")
+            search_deadline = (
+                args.search_deadline / 1000 if args.search_deadline else None
+            )
 
-                futures = {}
-                record_count = 0
-                while record_count < executor._max_workers * 2:  # prime the work queue
-                    record = get_next_record(reader)
-                    if not record:
-                        break
-                    record_count += 1
-                    futures[executor.submit(engine.search, record_count, record)] = (
-                        record
+            def submit_search(row_id, record):
+                return scheduler.submit(
+                    row_id,
+                    record,
+                    "batch",
+                    time.time() + search_deadline if search_deadline else None,
+                )
+
+            search_records = read_search_records(reader)
+
+            # rows with the same search payload as a search in flight wait for its
+            # result, rows matching a recently finished search reuse its entities,
+            # either way their filtering and formatting is done on the scheduler
+            futures = {}
+            pending_duplicates = {}
+            finished_searches = collections.OrderedDict()
+            ready_results = []
+
+            def queued_row_count():
+                return (
+                    len(futures)
+                    + len(ready_results)
+                    + sum(len(x) for x in pending_duplicates.values())
+                )
+
+            def queue_next_row():
+                """submits or attaches the next row, returns False at the end of the file"""
+                search_row = get_next_record(search_records)
+                if not search_row:
+                    return False
+                row_id, search_record, error = search_row
+                if error:
+                    ready_results.append(
+                        {
+                            "error": error,
+                            "search_record": {"ROW_ID": row_id},
+                            "api_ms": 0,
+                            "fmt_ms": 0,
+                        }
+                    )
+                    return True
+                record_key = (
+                    search_record_key(search_record) if args.dedupe_cache_size else None
+                )
+                if record_key in pending_duplicates:
+                    pending_duplicates[record_key].append((row_id, search_record))
+                elif record_key in finished_searches:
+                    finished_searches.move_to_end(record_key)
+                    stat_pack["counts"]["duplicate_count"] += 1
+                    duplicate_future = scheduler.submit_duplicate(
+                        finished_searches[record_key], row_id, search_record
                     )
+                    futures[duplicate_future] = None
+                else:
+                    futures[submit_search(row_id, search_record)] = record_key
+                    if record_key:
+                        pending_duplicates[record_key] = []
+                return True
+
+            with (
+                contextlib.nullcontext(shared_scheduler)
+                if shared_scheduler
+                else SearchScheduler(engine, max_workers)
+            ) as scheduler:
+                logging.info(f"searching on {scheduler.thread_count} threads")
+
+                # prime the work queue
+                while queued_row_count() < scheduler.thread_count * 2:
+                    if not queue_next_row():
+                        break
 
-                while futures:
+                while futures or ready_results:
                     done, _ = concurrent.futures.wait(
-                        futures, return_when=concurrent.futures.FIRST_COMPLETED
+                        futures,
+                        timeout=0 if ready_results else args.stats_interval or None,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
                     )
                     for fut in done:
-
+                        record_key = futures.pop(fut)
+                        search_result = fut.result()
+                        ready_results.append(search_result)
+                        if not record_key:
+                            continue
+                        for row_id, search_record in pending_duplicates.pop(record_key):
+                            stat_pack["counts"]["duplicate_count"] += 1
+                            duplicate_future = scheduler.submit_duplicate(
+                                search_result, row_id, search_record
+                            )
+                            futures[duplicate_future] = None
+                        if "error" not in search_result:
+                            # the returned entities are all a duplicate row needs
+                            finished_searches[record_key] = {
+                                "returned_entities": search_result["returned_entities"]
+                            }
+                            if len(finished_searches) > args.dedupe_cache_size:
+                                finished_searches.popitem(last=False)
+
+                    for response_data in ready_results:
                         start_time = time.time()
-                        response_data = fut.result()
 
                         stat_pack["counts"]["search_count"] += 1
-                        if "error" in response_data:
+                        if response_data.get("expired"):
+                            stat_pack["counts"]["expired_count"] += 1
+                        elif "error" in response_data:
                             logging.warning(
                                 f"search record {response_data['search_record']['ROW_ID']} returned {response_data['error']}"
                             )
@@ -477,34 +1144,32 @@ def file_search(engine, input_file, output_file, column_headers):
                             csv_writer.writerows(queued_csv_rows)
                             queued_csv_rows = []
 
-                            response = bytearray()
-                            engine.g2_engine.stats(response)
-                            print(f"\n{response.decode()}\n")
-
-                            logging.info(f"\n{json.dumps(stat_pack, indent=4)}")
-                            with open(json_output_file, "w") as out_file:
-                                out_file.write(json.dumps(stat_pack, indent=4))
-
-                        futures.pop(fut)
-                        if not shut_down:
-                            record = get_next_record(reader)
-                            if record:
-                                record_count += 1
-                                futures[
-                                    executor.submit(engine.search, record_count, record)
-                                ] = record
-
-                if args.debug:
-                    try:
-                        response = bytearray()
-                        engine.g2_engine.stats(response)
-                        stats = response.decode()
-                        logging.debug(f"\n{stats}")
-                    except:
-                        pass
+                            stats_writer.submit(stat_pack)
+
+                    ready_results.clear()
+
+                    while (
+                        not shut_down
+                        and queued_row_count() < scheduler.thread_count * 2
+                    ):
+                        if not queue_next_row():
+                            break
+
+                    if stats_recorder.due():
+                        stats_recorder.sample(
+                            stat_pack["counts"]["search_count"], len(futures)
+                        )
 
         csv_writer.writerows(queued_csv_rows)
 
+    if profiler:
+        profiler.stop()
+        profiler.write_collapsed(output_file_name + "_profile.folded")
+        profiler.write_summary(output_file_name + "_profile.json")
+        logging.info(
+            f"{profiler.sample_count} profile samples written to {output_file_name}_profile.folded"
+        )
+
     stat_pack["timings"]["ended"] = datetime.strftime(
         datetime.now(), "%Y-%m-%d %H:%M:%S"
     )
@@ -601,20 +1266,6 @@ def file_search(engine, input_file, output_file, column_headers):
             5,
         )
 
-    stat_pack["match_keys"]["best"] = dict(
-        sorted(
-            stat_pack["match_keys"]["best"].items(),
-            key=lambda item: item[1],
-            reverse=True,
-        )
-    )
-    stat_pack["match_keys"]["all"] = dict(
-        sorted(
-            stat_pack["match_keys"]["all"].items(),
-            key=lambda item: item[1],
-            reverse=True,
-        )
-    )
     if stat_pack["counts"]["search_count"] > 0:
         stat_pack["percents"]["found_pct"] = round(
             stat_pack["counts"]["found_count"]
@@ -641,13 +1292,17 @@ def file_search(engine, input_file, output_file, column_headers):
             2,
         )
 
-    response = bytearray()
-    engine.g2_engine.stats(response)
-    print(f"\n{response.decode()}\n")
+    stats_sample = stats_recorder.sample(stat_pack["counts"]["search_count"], 0)
+    if args.debug and stats_sample:
+        logging.debug(f"\n{json.dumps(stats_sample['stats'], indent=4)}")
+    logging.info(
+        f"{stats_recorder.sample_count} engine stats samples written to {stats_recorder.file_name}"
+    )
 
-    logging.info(f"\n{json.dumps(stat_pack, indent=4)}")
-    with open(json_output_file, "w") as out_file:
-        out_file.write(json.dumps(stat_pack, indent=4))
+    stats_writer.close()
+    final_snapshot = stats_writer.snapshot(stat_pack)
+    stats_writer.write(final_snapshot)
+    logging.info(f"\n{json.dumps(final_snapshot, indent=4)}")
 
 
 def get_engine_config_from_ini():
@@ -680,11 +1335,7 @@ def signal_handler(signal, frame):
     shut_down = 9
 
 
-if __name__ == "__main__":
-
-    shut_down = 0
-    signal.signal(signal.SIGINT, signal_handler)
-
+def get_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-c",
@@ -704,6 +1355,20 @@ if __name__ == "__main__":
         default=0,
         help="number of threads to start, defaults to max available",
     )
+    parser.add_argument(
+        "-mk",
+        "--match_key_limit",
+        type=int,
+        default=0,
+        help="only keep the top (n) match keys in the json stats file, the rest are counted as other",
+    )
+    parser.add_argument(
+        "-sd",
+        "--search_deadline",
+        type=int,
+        default=0,
+        help="milliseconds a search may wait for a thread before it is skipped, defaults to no deadline",
+    )
     parser.add_argument(
         "-A",
         "--do_audit",
@@ -712,6 +1377,45 @@ if __name__ == "__main__":
         default=False,
         help="compute precision and recall (requires expected record_id in search record)",
     )
+    parser.add_argument(
+        "-si",
+        "--stats_interval",
+        type=int,
+        default=60,
+        help="seconds between engine stats samples, defaults to 60 (0 only samples at the end)",
+    )
+    parser.add_argument(
+        "-dc",
+        "--dedupe_cache_size",
+        type=int,
+        default=1000,
+        help="number of recent search results reused by records with the same search attributes, defaults to 1000 (0 searches every record)",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        default=False,
+        help="sample all threads during the run, writes collapsed stacks and a function summary next to the json stats file",
+    )
+    parser.add_argument(
+        "--profile_interval",
+        type=int,
+        default=10,
+        help="milliseconds between profile samples, defaults to 10",
+    )
+    parser.add_argument(
+        "--profile_warmup",
+        type=int,
+        default=0,
+        help="seconds to wait before profile sampling starts, defaults to 0",
+    )
+    parser.add_argument(
+        "--profile_duration",
+        type=int,
+        default=0,
+        help="seconds to keep profile sampling once started, defaults to the whole run",
+    )
     parser.add_argument(
         "-D",
         "--debug",
@@ -720,7 +1424,16 @@ if __name__ == "__main__":
         default=False,
         help="run in debug mode",
     )
-    args = parser.parse_args()
+    return parser
+
+
+shut_down = 0
+
+if __name__ == "__main__":
+
+    signal.signal(signal.SIGINT, signal_handler)
+
+    args = get_arg_parser().parse_args()
 
     if args.debug:
         loggingLevel = logging.DEBUG
@@ -771,6 +1484,7 @@ if __name__ == "__main__":
             "match_score_filter", 0
         )
         search_kwargs["scoring_config"] = config_data.get("scoring", {})
+        search_kwargs["do_audit"] = args.do_audit
         column_headers, column_mappings = prepare_output(
             config_data.get("output_columns", [])
         )